@@ -3,9 +3,13 @@ import os
 import re
 import warnings
 import logging
-import numbers
+import io
+import codecs
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote, urljoin
+import numpy as np
 import pandas as pd
 from dataclasses import dataclass
 
@@ -18,6 +22,13 @@ BASE_URL = 'https://www.kaufland.hr/akcije-novosti/popis-mpc.html'
 
 GITHUB_WARNING = "::warning::"
 
+# one keep-alive session for all kaufland.hr requests: TLS handshake only once
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+SESSION.headers.update({"Connection": "keep-alive"})
+
+REQUEST_TIMEOUT = (5, 30)  # (connect, read) seconds
+
 PRICE_MAP = {
         # old name: new name
         "maloprod.cijena(EUR)": "price",
@@ -40,12 +51,33 @@ FIELD_MAP = {
         "WG": "category"
     }
 
+COL_MAP = PRICE_MAP | FIELD_MAP
+
+CSV_COLUMNS = set(COL_MAP)
+
+CSV_DTYPES = {
+        # raw name: dtype, numerics parsed by the C engine with decimal=","
+        "maloprod.cijena(EUR)": "float64",
+        "cijena jed.mj.(EUR)": "float64",
+        "Najniža MPC u 30dana": "string[pyarrow]",
+        "Sidrena cijena": "string[pyarrow]",
+        "naziv proizvoda": "string[pyarrow]",
+        "marka proizvoda": "string[pyarrow]",
+        "akc.cijena, A=akcija": "string[pyarrow]",
+        "jed.mj. (1 KOM/L/KG)": "string[pyarrow]",
+        "kol.jed.mj.": "float64",
+        "neto količina(KG)": "float64",
+        "jedinica mjere": "string[pyarrow]",
+        "barkod": "string[pyarrow]",
+        "WG": "string[pyarrow]"
+    }
+
 def find_assetlist_url_static(base_url):
     """
     Fetches the HTML and searches for the dynamic assetList_*.json URL.
     """
 
-    response = requests.get(base_url)
+    response = SESSION.get(base_url, timeout=REQUEST_TIMEOUT)
     response.raise_for_status() # Raise an exception for bad status codes
 
     html_content = response.text
@@ -58,26 +90,37 @@ def find_assetlist_url_static(base_url):
     else:
         print("File pattern not found in static HTML.")
 
+FILENAME_SPLIT_RE = re.compile(r'_+')
+
+# multiword cities, rejoined after splitting the filename on underscores
+CITY_JOINS = {("Dugo", "Selo"): "Dugo Selo",
+              ("Slavonski", "Brod"): "Slavonski Brod",
+              ("Velika", "Gorica"): "Velika Gorica",
+              ("Nova", "Gradiska"): "Nova Gradiska",
+              ("Zagreb", "Blato"): "Zagreb Blato"}
+
 def normalize_filename_txt_kf(x: str):
     """
     filenames contain metadata on stores (ids, cities,...) and dates, parse those
     """
     
-    # Manual replacements
-    replacements = {'Dugo_Selo': 'Dugo Selo',
-                    'Slavonski_Brod': 'Slavonski Brod',
-                    'Velika_Gorica': 'Velika Gorica',
-                    "Nova_Gradiska": "Nova Gradiska",
-                    "Zagreb_Blato": "Zagreb Blato"}
-    
-    x = x.removesuffix(".csv").strip()
-    
-    for old, new in replacements.items():
-            x = x.replace(old, new)
+    parts = FILENAME_SPLIT_RE.split(x.removesuffix(".csv").strip())
     
-    x = re.split(r'_+', x)
+    # single sweep merging adjacent pairs found in CITY_JOINS
+    merged = []
+    i = 0
+    while i < len(parts):
+        joined = CITY_JOINS.get(tuple(parts[i:i + 2]))
+        if joined:
+            merged.append(joined)
+            i += 2
+        else:
+            merged.append(parts[i])
+            i += 1
     
-    return x
+    return merged
+
+METADATA_FIELDS = ["store_size", "address", "city", "store_id", "date", "time"]
 
 def filename_structure_match_kf(parts: list) -> dict:
     """ get metadata from filename """
@@ -106,157 +149,243 @@ def filename_structure_match_kf(parts: list) -> dict:
 def fetch_stores_dates():
     url = f"https://www.kaufland.hr/akcije-novosti/popis-mpc.assetSearch.id=assetList_{dynamic_number}.json"
 
-    response = requests.get(url)
+    response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
 
-    csv_links = response.json()
+    csv_links = orjson.loads(response.content)
 
     filenames = [item["label"] for item in csv_links]
 
     normalized_filenames =[normalize_filename_txt_kf(name) for name in filenames]
 
-    metadata = pd.DataFrame([filename_structure_match_kf(nf) for nf in normalized_filenames])
+    # collect metadata column-wise, malformed filenames become a row of NAs
+    columns = {field: [] for field in METADATA_FIELDS}
+    for nf in normalized_filenames:
+        meta = filename_structure_match_kf(nf)
+        for field, values in columns.items():
+            values.append(meta.get(field))
+
+    metadata = pd.DataFrame(columns | {
+        "store_id": pd.array(pd.to_numeric(columns["store_id"]), dtype="Int16"),
+        "path": [item["path"] for item in csv_links]
+    })
     
     metadata.date = metadata.date.str.strip()
-    metadata["path"] = [item["path"] for item in csv_links]
     
     # safe quote of empty spaces in URL:
     metadata["url"] = "https://www.kaufland.hr" + metadata["path"].map(lambda p: quote(str(p), safe="/"))
 
     df_url = metadata.assign(
-        date=pd.to_datetime(metadata["date"], format="%d%m%Y"),
-        store_id=pd.to_numeric(metadata["store_id"]).astype("Int16")
+        date=pd.to_datetime(metadata["date"], format="%d%m%Y")
     )
     
     return df_url
 
+# encoding: label printed to the log
+ENCODING_LABELS = {"utf-8": "UTF-8", "windows-1250": "WIN-1250"}
+
+def sniff_encoding_kf(content: bytes, chunk_size=1 << 16) -> str:
+    """ utf-8 if the bytes decode cleanly, win-1250 otherwise; validated chunk by chunk """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    view = memoryview(content)
+    try:
+        for start in range(0, len(view), chunk_size):
+            decoder.decode(view[start:start + chunk_size])
+        decoder.decode(b"", final=True)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "windows-1250"
+
 def read_csv_kf(filename):
     """
     use tab separator and comma decimal
-    enconding: try utf-8, fall back to win-1250
+    enconding: utf-8 if valid, else win-1250; sniffed on the raw bytes so the csv is parsed once
     """
+    response = SESSION.get(filename, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    content = response.content
+
+    encoding = sniff_encoding_kf(content)
     try:
-        # Try UTF-8 first
-        df = pd.read_csv(filename, delimiter="\t", decimal=",", encoding="utf-8",
-                         dtype={"Najniža MPC u 30dana": str})
-        print(f"UTF-8   : {filename}")
-        return df
-    except UnicodeDecodeError:
-        try:
-            df = pd.read_csv(filename, delimiter="\t", decimal=",", encoding="windows-1250",
-                             dtype={"Najniža MPC u 30dana": str})
-            print(f"WIN-1250: {filename}")
-            return df
-        except Exception as e:
-            print(f"Both encodings failed: {e}")
-            return None
-
-def replace_with_dot_if_number(x):
-    # import numbers
-    if pd.isna(x):
-        return pd.NA
-    if not isinstance(x, numbers.Number):
-        if len(x) == 0:
-            return pd.NA
-        else:
-            return x.replace(",", ".")
+        df = pd.read_csv(io.BytesIO(content), delimiter="\t", decimal=",", encoding=encoding,
+                         engine="c", usecols=lambda c: c in CSV_COLUMNS, dtype=CSV_DTYPES,
+                         na_values=["", "-"])
+    except Exception as e:
+        print(f"Parsing as {encoding} failed: {e}")
+        return None
+
+    print(f"{ENCODING_LABELS[encoding]:8}: {filename}")
+    return df
+
+def prepare_anchor(s: pd.Series) -> pd.DataFrame:
+    """ split 'date=price' anchors into stripped (date, price) columns, NA if malformed """
+    s = s.astype("string")
+    missing = s.isna()
+    valid = s.str.count("=").eq(1).fillna(False).astype(bool)
+    if missing.any():
+        logging.warning(f"Encountered {missing.sum()} missing values")
+    malformed = ~valid & ~missing
+    if malformed.any():
+        logging.warning(f"No or multiple '=' found in {malformed.sum()} rows, e.g. {s[malformed].head(5).tolist()}")
+    parts = s.where(valid).str.split("=", n=1, expand=True).reindex(columns=[0, 1])
+    return parts.apply(lambda col: col.astype("string").str.strip())
+
+# sample shape: strptime format, day first; trailing dots are stripped before matching
+ANCHOR_DATE_FORMATS = {
+        re.compile(r"\d{1,2}\.\d{1,2}\.\d{4}"): "%d.%m.%Y",
+        re.compile(r"\d{1,2}/\d{1,2}/\d{4}"): "%d/%m/%Y",
+        re.compile(r"\d{1,2}-\d{1,2}-\d{4}"): "%d-%m-%Y",
+    }
+
+def parse_anchor_date(s: pd.Series) -> pd.Series:
+    """
+    parse with an explicit format detected on the first value (fast path),
+    rows that don't fit it fall back to per-element mixed parsing
+    """
+    sample = s.dropna()
+    fmt = next((fmt for pattern, fmt in ANCHOR_DATE_FORMATS.items()
+                if len(sample) and pattern.fullmatch(sample.iloc[0])), None)
+    if fmt is None:
+        parsed = pd.to_datetime(s, format="mixed", dayfirst=True, errors="coerce")
     else:
-        return x
-
-def prepare_anchor(s: str):
-    if pd.isna(s):
-        logging.warning("Encountered missing value")
-        return pd.Series([pd.NA, pd.NA])
-    if s.count('=') != 1:
-        logging.warning(f"No or multiple '=' found in: {s}")
-        return pd.Series([pd.NA, pd.NA])
-    date, price = s.split('=', 1)
-    return pd.Series([date.strip(), price.strip()])
+        parsed = pd.to_datetime(s, format=fmt, errors="coerce", cache=True)
+        leftover = parsed.isna() & s.notna()
+        if leftover.any():
+            parsed[leftover] = pd.to_datetime(s[leftover], format="mixed", dayfirst=True, errors="coerce")
+
+    # the unit pandas infers differs between the two paths, pin it
+    return parsed.astype("datetime64[us]")
+
+TIDY_DTYPES = {
+        # numeric columns tidy uses or produces, as nullable floats; strings are typed at read time
+        "quantity": "Float64",
+        "price": "Float64",
+        "unit_price": "Float64",
+        "best_price_30": "Float64",
+        "anchor_price": "Float64",
+        "price_anchor_diff": "Float64"
+    }
 
 def tidy(df):
         
+        best_price_30 = df["best_price_30"].str.strip()
         df["best_price_30"] = (
-            df["best_price_30"]
-            .str.replace(r"[^\d\.\,\-]", "", regex=True) # sanitize numbers, allow comma and dot
+            best_price_30
+            .str.removeprefix("*")
+            .str.removesuffix("€")
+            .str.removesuffix("€ur")
+            .str.replace(",", ".", regex=False) # decimal comma
             .pipe(pd.to_numeric, errors="coerce")
         )
 
-        df[["date_to_parse", "price_to_parse"]] = df.anchor_price_date.apply(prepare_anchor)
+        unparsed = best_price_30.notna() & best_price_30.ne("") & df["best_price_30"].isna()
+        if unparsed.any():
+            logging.warning(f"Could not parse {unparsed.sum()} best_price_30 values, e.g. {best_price_30[unparsed].head(5).tolist()}")
 
-        df["anchor_date"] = pd.to_datetime(
-                df["date_to_parse"].str.removeprefix("MPC").str.strip(),
-                format="mixed", dayfirst=True, errors="coerce")
+        df[["date_to_parse", "price_to_parse"]] = prepare_anchor(df.anchor_price_date)
+
+        df["anchor_date"] = parse_anchor_date(
+                df["date_to_parse"].str.removeprefix("MPC").str.strip().str.rstrip("."))
 
         df["anchor_price"] = pd.to_numeric(
                 df["price_to_parse"]
                 .str.removesuffix("€")
                 .str.removesuffix("€ur")
-                .map(replace_with_dot_if_number))
-        
-        # df["best_price_30"] = pd.to_numeric(
-        #         df["best_price_30"]
-        #         # .str.removeprefix("*")
-        #         .map(replace_with_dot_if_number))
+                .str.replace(",", ".", regex=False),
+                errors="coerce")
+
+        # zero anchor price has no meaningful relative difference, leave it NA
+        price = df["price"].to_numpy(dtype="float64", na_value=np.nan)
+        anchor = df["anchor_price"].to_numpy(dtype="float64", na_value=np.nan)
+        diff = np.divide(price - anchor, anchor, out=np.full_like(price, np.nan), where=(anchor != 0))
 
         df = df.assign(
                 product_name = df["product_name"].str.upper(),
-                quantity = pd.to_numeric(df["quantity"]),
                 kol_jed_mj = pd.to_numeric(df["kol_jed_mj"], downcast="integer"),
-                price_anchor_diff = (df["price"] - df["anchor_price"]) / df["anchor_price"],
-                is_akcija = pd.to_numeric(df["is_akcija"].replace("A", "1").fillna("0"), downcast="integer"))
+                price_anchor_diff = pd.array(diff, dtype="Float64"),
+                is_akcija = df["is_akcija"].eq("A").fillna(False).astype("int8"))
                 
         return (df
-        .convert_dtypes()
+        .astype({col: dtype for col, dtype in TIDY_DTYPES.items() if col in df.columns})
         .drop(columns=["anchor_price_date", "date_to_parse", "price_to_parse"]))
 
+# favourites matched on product name alone, OR-ed into a single alternation
+FAV_NAME_NEEDLES = [
+        "TOFU",
+        "KFAV.FARFALLE|KFAV.LINGUINE",
+        "MOLISANA",
+        "PROSENA KAŠA",
+        "OCTENA ESENCIJA",
+        "RICE UP",
+        "KLC.LEĆA",
+        "TORTERIE",
+        "BARATTOLINO",
+        "KLC.BIO PAP.VREĆA ZA SMEĆE",
+        "KLC.DETERDŽENT ZA PRA. POSU.U PRAHU",
+        "KH-7",
+        "VEDRINI",
+        "KFAV.ČOKOLADA TAMNA",
+        "YOGI ČAJ CLASSIC",
+        "KBIO.RAJČICE",
+    ]
+
+FAV_NAME_PATTERN = re.compile("|".join(FAV_NAME_NEEDLES))
+
 def FILT_FAVORITES(df):
+        name = df.product_name.str
+        brand = df.brand.str
+        qty = df.quantity
         FILT_FAVORITES = (
-                df.product_name.str.contains("PILSNER URQ") & df.product_name.str.contains("PB|4X") |  # obuhvaća staklenu bocu i 4xlimenke
-                df.product_name.str.contains("GARDEN") & df.product_name.str.contains("%") |
-                df.product_name.str.contains("ARBORIO|CARNAROLI|ORIGINARIO") & df.brand.str.contains("Riso Scotti") |
-                df.product_name.str.contains("TOFU") |
-                df.product_name.str.contains("TJESTENINA") & df.brand.str.startswith("K-Fav") |
-                df.product_name.str.contains("KFAV.FARFALLE|KFAV.LINGUINE") |
-                df.product_name.str.contains("MOLISANA") |
-                df.product_name.str.startswith("KVEG") & df.product_name.str.contains("NAPITAK ZOB") |
-                df.product_name.str.contains("PROSENA KAŠA") |
-                df.product_name.str.contains("KAVA") & df.product_name.str.contains("ZRN") & df.product_name.str.contains("BRAS") |
-                df.product_name.str.contains("OCTENA ESENCIJA") |
-                df.product_name.str.contains("INDOMIE") & df.product_name.str.contains("POVRĆE") |
-                df.product_name.str.contains("HUMUS|HUMMUS") & (df.quantity > .15) |
-                df.product_name.str.contains("RICE UP") |
-                df.product_name.str.contains("KLC.LEĆA") |
-                df.product_name.str.contains("TORTERIE") |
-                df.product_name.str.contains("BARATTOLINO") |
-                df.product_name.str.contains("MASLAC") & df.product_name.str.contains("DUKAT|BREGOV") & (df.quantity > .2) |
-                df.product_name.str.contains("KLC.BIO PAP.VREĆA ZA SMEĆE") |
-                df.product_name.str.contains("KLC.DETERDŽENT ZA PRA. POSU.U PRAHU") |
-                df.product_name.str.contains("KH-7") |
-                df.product_name.str.contains("VEDRINI") |
-                df.product_name.str.contains("KFAV.ČOKOLADA TAMNA") |
-                df.product_name.str.contains("ECOVER") & df.product_name.str.contains("UNI") |
-                df.product_name.str.contains("YOGI ČAJ CLASSIC") |
-                df.product_name.str.contains("TORTILL") & df.brand.str.contains("K-") |
-                df.product_name.str.contains("TORTILL") & df.brand.str.contains("Fiesta") |
-                df.product_name.str.contains("PANETTONE") & (df.quantity >= 0.5) |
-                df.product_name.str.contains("ELEPHANT SLANO PECIVO SEZAM") & (df.quantity > .15) |
-                df.product_name.str.contains("ELEPHANT KREKERI TWIST KARAMEL") & (df.quantity > .15) |
-                df.product_name.str.contains("CIRIO|MUTTI") & df.product_name.str.contains("PASIRANA|PELATI") & (df.quantity > 0.391) |
-                df.product_name.str.contains("KBIO.RAJČICE")
+                name.contains(FAV_NAME_PATTERN) |
+                name.contains("PILSNER URQ") & name.contains("PB|4X") |  # obuhvaća staklenu bocu i 4xlimenke
+                name.contains("GARDEN") & name.contains("%") |
+                name.contains("ARBORIO|CARNAROLI|ORIGINARIO") & brand.contains("Riso Scotti") |
+                name.contains("TJESTENINA") & brand.startswith("K-Fav") |
+                name.startswith("KVEG") & name.contains("NAPITAK ZOB") |
+                name.contains("KAVA") & name.contains("ZRN") & name.contains("BRAS") |
+                name.contains("INDOMIE") & name.contains("POVRĆE") |
+                name.contains("HUMUS|HUMMUS") & (qty > .15) |
+                name.contains("MASLAC") & name.contains("DUKAT|BREGOV") & (qty > .2) |
+                name.contains("ECOVER") & name.contains("UNI") |
+                name.contains("TORTILL") & brand.contains("K-") |
+                name.contains("TORTILL") & brand.contains("Fiesta") |
+                name.contains("PANETTONE") & (qty >= 0.5) |
+                name.contains("ELEPHANT SLANO PECIVO SEZAM") & (qty > .15) |
+                name.contains("ELEPHANT KREKERI TWIST KARAMEL") & (qty > .15) |
+                name.contains("CIRIO|MUTTI") & name.contains("PASIRANA|PELATI") & (qty > 0.391)
                 )
         return FILT_FAVORITES
 
+# uppercase like product_name after tidy, so no case-insensitive matching is needed
+WEIZEN_PATTERN = re.compile(
+        "MAISELS|KROMBACHER PIVO WEIZEN|FRANZISKANER|BENEDIKTINER PIVO PŠE\\.|BENEDIKTINER PŠENIČNO PIVO|ERDINGER PIVO SVJ\\.|ERDINGER PIVO SVJET\\.")
+
 def FILT_WEIZEN(df):
+        name = df.product_name.str
         FILT_WEIZEN = (
-                df.product_name.str.contains(
-                        "maisels|Krombacher Pivo Weizen|franziskaner|Benediktiner Pivo pše\\.|Benediktiner pšenično pivo|Erdinger Pivo svj\\.|Erdinger Pivo svjet\\.", case=False
-                        ))
+                name.contains(WEIZEN_PATTERN))
         return FILT_WEIZEN
 
+SIR_PATTERN = re.compile("HALLOUMI|PARMI|PECORINO|PADANO")
+
 def FILT_SIR(df):
+        name = df.product_name.str
+        qty = df.quantity
         FILT_SIR = (
-                (df.product_name.str.contains("halloumi|parmi|pecorino|padano", case=False)) & (df.quantity >= .2))
+                (name.contains(SIR_PATTERN)) & (qty >= .2))
         return FILT_SIR
 
+def FILT_ALL(df):
+        """
+        FILT_FAVORITES, FILT_WEIZEN and FILT_SIR as boolean columns of one frame.
+        """
+        FILT_ALL = pd.DataFrame({
+                "fav": FILT_FAVORITES(df),
+                "weizen": FILT_WEIZEN(df),
+                "sir": FILT_SIR(df)
+                }, index=df.index)
+        return FILT_ALL.fillna(False).astype(bool)
+
 def style_dataframe(df: pd.DataFrame,
                     caption=f"UPDATED: {pd.Timestamp.now().strftime("%d.%m.%Y %H:%M")}",
                     header_color="indigo",  #  header_color="#4CAF50",
@@ -313,12 +442,13 @@ def style_dataframe(df: pd.DataFrame,
     
     return styled
 
-def highlight_rows_by_value(row, target_value=1, target_column="is_akcija", highlight_color="CornSilk"):
-    """Function to highlight entire row if 'value' == target_value"""
-    if row[target_column] == target_value:
-        return [f"background-color: {highlight_color}" for _ in row]
-    else:
-        return ["" for _ in row]
+AKCIJA_CLASS = "akcija"  # td class of rows on promotion, styled in __main__
+
+def row_classes_by_value(df, target_value=1, target_column="is_akcija", css_class=AKCIJA_CLASS):
+    """Styler.set_td_classes frame: css_class on every cell of rows where target_column == target_value"""
+    classes = pd.DataFrame("", index=df.index, columns=df.columns)
+    classes.loc[df[target_column].eq(target_value).fillna(False).to_numpy(dtype=bool), :] = css_class
+    return classes
 
 def one_row_df_to_series(df):
     return df.squeeze(axis=0)
@@ -330,13 +460,12 @@ if __name__ == "__main__":
     df_url = fetch_stores_dates()
     url_filtered = df_url[(df_url["date"] == TODAY) & (df_url["store_id"] == KF_ZD.id)].url.squeeze()
     df_in = read_csv_kf(url_filtered)
-    df_in = df_in.rename(columns=PRICE_MAP | FIELD_MAP)
+    df_in.rename(columns=COL_MAP, inplace=True)
     df = tidy(df_in)
     
-    dff = df[(FILT_WEIZEN(df) | FILT_FAVORITES(df) | FILT_SIR(df))]
+    dff = df[FILT_ALL(df).any(axis=1)]
     
     dff_favs_razlika = (dff
-    .astype({col: 'float64' for col in dff.filter(like='price').columns})
     .filter(items=["product_name", "price", 'unit', 'unit_price', "anchor_price", "price_anchor_diff", "is_akcija"])
     .sort_values("price_anchor_diff")
     )
@@ -350,9 +479,11 @@ if __name__ == "__main__":
             "anchor_price": "€{:.2f}",
             "price_anchor_diff": "{:.1%}"})
 
-    styled = styled.apply(
-            lambda row: highlight_rows_by_value(row, highlight_color="LightBlue"),
-            axis=1)
+    # row highlight as one CSS class rule, not an inline style per cell
+    styled = (styled
+        .set_td_classes(row_classes_by_value(dff_favs_razlika))
+        .set_table_styles([{"selector": f"td.{AKCIJA_CLASS}", "props": [("background-color", "LightBlue")]}],
+                          overwrite=False))
 
     Path("output").mkdir(exist_ok=True)
     styled.to_html(Path("output", "index.html"))